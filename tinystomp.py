@@ -27,11 +27,59 @@ Ultra-minimal STOMP protocol parser/generator.
 
 from __future__ import absolute_import
 import collections
+import errno
 import functools
+import itertools
+import mmap
+import os
+import random
 import re
 import socket
+import struct
 import time
-import urlparse
+import zlib
+
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+
+
+_text_type = type(u'')
+
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        """
+        Return a zero-copy view of `size` bytes of `obj` from `offset`.
+        """
+        return memoryview(obj)[offset:offset+size]
+
+
+def _encode(value):
+    """
+    Return `value` as a bytestring, encoding any text as UTF-8. A bytearray or
+    memoryview is copied, anything else is converted using :py:func:`str`.
+    """
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    elif isinstance(value, bytearray):
+        value = bytes(value)
+    elif not isinstance(value, bytes):
+        if not isinstance(value, _text_type):
+            value = str(value)
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+    return value
+
+
+if bytes is str:
+    def _native(s):
+        return s
+else:
+    def _native(s):
+        return s.decode('utf-8', 'replace')
 
 
 class Error(Exception):
@@ -46,12 +94,24 @@ class ProtocolError(Error):
     """
 
 
+class SpoolFull(Error):
+    """
+    Raised when a frame does not fit in a :py:class:`Spool`.
+    """
+
+
 class Frame(object):
     """
     Represent a parsed STOMP frame.
     """
     #: None, or bytestring message body.
     body = None
+    #: None, or time the first byte of the frame was received, if the parser
+    #: records timestamps.
+    arrived = None
+    #: None, or time parsing of the frame finished, if the parser records
+    #: timestamps.
+    parsed = None
 
     def __init__(self, command):
         #: Bytestring command verb.
@@ -60,15 +120,88 @@ class Frame(object):
         self.headers = {}
 
     def __repr__(self):
-        bits = ['%s %s' % p for p in self.headers.iteritems()]
+        bits = ['%s %s' % (_native(k), _native(v))
+                for k, v in self.headers.items()]
         bits.sort()
         headers = '\n    '.join(bits)
+        body = self._repr_body()
         return '<%s %r {\n    %s\n}>' % (
-            self.command,
-            self.body and (self.body[:20]+'..'),
+            _native(self.command),
+            body and (body[:20]+b'..'),
             headers,
         )
 
+    def _repr_body(self):
+        return self.body
+
+
+class EncodedFrame(Frame):
+    """
+    Represent a parsed STOMP frame whose body was compressed by the sender, as
+    indicated by its ``content-encoding`` header. The body is only decoded the
+    first time it is accessed. If decoding fails, accessing :py:attr:`body`
+    raises every time, while :py:attr:`raw_body` remains available.
+    """
+    _decoded = False
+
+    def __init__(self, command, decoder, raw_body):
+        super(EncodedFrame, self).__init__(command)
+        #: Bytestring message body as it was received.
+        self.raw_body = raw_body
+        self._decoder = decoder
+
+    @property
+    def body(self):
+        if not self._decoded:
+            self._body = self._decoder(self.raw_body)
+            self._decoded = True
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self._decoded = True
+
+    def _repr_body(self):
+        # Never decode just to print the frame.
+        return self._body if self._decoded else self.raw_body
+
+
+#: Largest body :py:data:`DECODERS` will produce, to bound the memory a small
+#: compressed frame can claim.
+MAX_DECODED_SIZE = 64 << 20
+
+
+def _inflate(data):
+    """
+    Decompress a zlib-wrapped or raw deflate body, raising
+    :py:class:`ProtocolError` if it is invalid or decompresses to more than
+    :py:data:`MAX_DECODED_SIZE` bytes.
+    """
+    # Producers disagree on whether "deflate" means a zlib stream or a raw
+    # one, so accept both.
+    try:
+        obj = zlib.decompressobj()
+        body = obj.decompress(data, MAX_DECODED_SIZE)
+    except zlib.error:
+        try:
+            obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            body = obj.decompress(data, MAX_DECODED_SIZE)
+        except zlib.error as e:
+            raise ProtocolError('cannot decode deflate body: %s' % (e, ))
+    if obj.unconsumed_tail:
+        raise ProtocolError('decoded body exceeds %d bytes'
+                            % (MAX_DECODED_SIZE, ))
+    return body
+
+
+#: Map ``content-encoding`` header values to functions that decode a body
+#: encoded that way, for use with :py:class:`Parser`. Frames with any other
+#: encoding are left untouched.
+DECODERS = {
+    b'deflate': _inflate,
+}
+
 
 def parse_url(url):
     """
@@ -81,7 +214,8 @@ def parse_url(url):
     return host, int(port)
 
 
-_double_eol_pat = re.compile('\r?\n\r?\n')
+_double_eol_pat = re.compile(b'\r?\n\r?\n')
+_eols_pat = re.compile(b'[\r\n]*')
 def split_frame(s, start, stop):
     """
     Find and split all the command and header lines from the first frame in
@@ -90,6 +224,9 @@ def split_frame(s, start, stop):
 
     Ignores any pair of consecutive EOLs prefixing s to prevent header parsing
     from failing when vertical whitespace is present (allowed by the protocol).
+
+    `s` may be any object supporting slicing and the buffer protocol, such as
+    a bytearray or mmap. The lines are always bytestrings.
     """
     for m in _double_eol_pat.finditer(s, start, stop):
         mstart, mend = m.span()
@@ -97,7 +234,7 @@ def split_frame(s, start, stop):
         # prefixing EOLs have been found. Note the new starting position and
         # continue looping in that case.
         if start != mstart:
-            lines = s[start:mstart].splitlines()
+            lines = bytes(s[start:mstart]).splitlines()
             return mend, iter(lines)
         start = mend
     return 0, iter(())
@@ -110,20 +247,51 @@ def split_frame(s, start, stop):
 
 def _format(command, body, headers):
     """
-    Return a formatted STOMP frame as a bytestring.
+    Return a formatted STOMP frame as a bytestring. `body` may be a bytestring,
+    text to be encoded as UTF-8, or on Python 3 any object supporting the
+    buffer protocol. Header values may be bytestrings, bytearrays,
+    memoryviews, text, or any other object that is converted using
+    :py:func:`str`.
     """
-    bits = [command, '\n']
+    bits = [command, b'\n']
     if body:
-        bits.extend(('content-length:', str(len(body)), '\n'))
+        if isinstance(body, _text_type):
+            body = body.encode('utf-8')
+        bits.extend((b'content-length:', _encode(_size(body)), b'\n'))
 
-    for key, value in headers.iteritems():
-        bits.extend((key.replace('_', '-'), ':', str(value), '\n',))
+    for key, value in headers.items():
+        bits.extend((_encode(key.replace('_', '-')), b':', _encode(value),
+                     b'\n'))
     bits.extend((
-        '\n',
-        body or '',
-        '\x00'
+        b'\n',
+        body or b'',
+        b'\x00'
     ))
-    return ''.join(bits)
+    return b''.join(bits)
+
+
+def _size(body):
+    """
+    Return the length of `body` in bytes. A memoryview's ``len()`` counts
+    items, which may be wider than a byte.
+    """
+    return body.nbytes if isinstance(body, memoryview) else len(body)
+
+
+def _deflate(body, headers, threshold):
+    """
+    If `threshold` is not ``None`` and `body` is longer than it, return `body`
+    compressed and add a ``content-encoding`` header to `headers`. Bodies that
+    do not shrink are returned unchanged.
+    """
+    if isinstance(body, _text_type):
+        body = body.encode('utf-8')
+    if threshold is not None and body and _size(body) > threshold:
+        zbody = zlib.compress(body)
+        if len(zbody) < _size(body):
+            headers['content_encoding'] = b'deflate'
+            return zbody
+    return body
 
 
 def connect(host, **headers):
@@ -132,15 +300,25 @@ def connect(host, **headers):
     """
     headers['accept_version'] = '1.0,1.1,1.2'
     headers['host'] = host
-    return _format('CONNECT', '', headers)
+    return _format(b'CONNECT', b'', headers)
 
 
-def send(destination, body=None, **headers):
+def send(destination, body=None, compress_=None, trace_=False, **headers):
     """
-    Generate a SEND frame.
+    Generate a SEND frame. If `compress_` is an integer, bodies longer than
+    that many bytes are compressed with zlib. If `trace_` is ``True``, add
+    ``trace-id`` and ``trace-sent`` headers for :py:class:`Tracer`.
+
+    Like `id_`, the options carry a trailing underscore so they cannot clash
+    with header names: ``compress=`` and ``trace=`` are sent as headers like
+    any other keyword.
     """
     headers['destination'] = destination
-    return _format('SEND', body, headers)
+    if trace_:
+        headers['trace_id'] = '%016x' % random.getrandbits(64)
+        headers['trace_sent'] = '%.6f' % time.time()
+    body = _deflate(body, headers, compress_)
+    return _format(b'SEND', body, headers)
 
 
 def subscribe(destination, **headers):
@@ -149,7 +327,7 @@ def subscribe(destination, **headers):
     """
     headers['destination'] = destination
     headers.setdefault('id', str(time.time()))
-    return _format('SUBSCRIBE', '', headers)
+    return _format(b'SUBSCRIBE', b'', headers)
 
 
 def unsubscribe(destination, id_, **headers):
@@ -158,7 +336,7 @@ def unsubscribe(destination, id_, **headers):
     """
     headers['destination'] = destination
     headers['id'] = id_
-    return _format('UNSUBSCRIBE', '', headers)
+    return _format(b'UNSUBSCRIBE', b'', headers)
 
 
 def ack(id_, **headers):
@@ -166,7 +344,7 @@ def ack(id_, **headers):
     Generate a ACK frame.
     """
     headers['id'] = id_
-    return _format('ACK', '', headers)
+    return _format(b'ACK', b'', headers)
 
 
 def nack(id_, **headers):
@@ -174,7 +352,7 @@ def nack(id_, **headers):
     Generate a NACK frame.
     """
     headers['id'] = id_
-    return _format('NACK', '', headers)
+    return _format(b'NACK', b'', headers)
 
 
 def begin(transaction, **headers):
@@ -182,7 +360,7 @@ def begin(transaction, **headers):
     Generate a BEGIN frame.
     """
     headers['transaction'] = transaction
-    return _format('BEGIN', '', headers)
+    return _format(b'BEGIN', b'', headers)
 
 
 def commit(transaction, **headers):
@@ -190,7 +368,7 @@ def commit(transaction, **headers):
     Generate a COMMIT frame.
     """
     headers['transaction'] = transaction
-    return _format('COMMIT', '', headers)
+    return _format(b'COMMIT', b'', headers)
 
 
 def abort(transaction, **headers):
@@ -198,7 +376,7 @@ def abort(transaction, **headers):
     Generate a ABORT frame.
     """
     headers['transaction'] = transaction
-    return _format('ABORT', '', headers)
+    return _format(b'ABORT', b'', headers)
 
 
 def disconnect(receipt, **headers):
@@ -206,7 +384,330 @@ def disconnect(receipt, **headers):
     Generate a DISCONNECT frame.
     """
     headers['receipt'] = receipt
-    return _format('DISCONNECT', '', headers)
+    return _format(b'DISCONNECT', b'', headers)
+
+
+#
+# Transactions.
+#
+
+
+class Batcher(object):
+    """
+    Group SEND frames into transactions, which many brokers persist far faster
+    than individually persisted sends. Frames are buffered until `size` sends
+    accumulate or `interval` seconds pass since the first of them, then the
+    whole BEGIN..COMMIT sequence is passed as one bytestring to `write`.
+
+    ::
+
+        b = tinystomp.Batcher(client.write, size=100, interval=0.5)
+        for body in bodies:
+            b.send('/queue/foo', body, persistent='true')
+        b.flush()
+
+    No timer is used: a partial batch is written only by a later
+    :py:meth:`send` or an explicit :py:meth:`flush`. When `write` is
+    :py:meth:`Client.write` of a client with a nonzero `bufsize`, the batch
+    joins the client's write buffer and still needs :py:meth:`Client.flush`
+    to reach the server.
+    """
+    #: Transaction ID of the batch being built, or ``None``.
+    transaction = None
+
+    def __init__(self, write, size=100, interval=1.0, prefix=None):
+        self.write = write
+        self.size = size
+        self.interval = interval
+        self.prefix = prefix or str(time.time())
+        self.frames = []
+        self.deadline = None
+        self._ids = itertools.count()
+
+    def send(self, destination, body=None, **headers):
+        """
+        Add a SEND frame to the current batch, writing the batch if it is full
+        or its interval has expired.
+        """
+        if self.transaction is None:
+            self.transaction = '%s-%d' % (self.prefix, next(self._ids))
+            self.deadline = time.time() + self.interval
+            self.frames.append(begin(self.transaction))
+        headers['transaction'] = self.transaction
+        self.frames.append(send(destination, body, **headers))
+        if len(self.frames) > self.size or time.time() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit and write the current batch, if any. If `write` raises, the
+        batch is kept and written again by the next :py:meth:`flush`.
+        """
+        if self.transaction is not None:
+            self.write(b''.join(self.frames + [commit(self.transaction)]))
+            self._reset()
+
+    def abort(self):
+        """
+        Discard the current batch. Nothing has reached the server yet, so no
+        ABORT frame is needed.
+        """
+        self._reset()
+
+    def _reset(self):
+        self.transaction = None
+        self.deadline = None
+        del self.frames[:]
+
+
+#
+# Spooling.
+#
+
+
+def _spoolable(pkt):
+    """
+    Return ``True`` if the formatted frame or frames in `pkt` may be replayed
+    in a later session: a SEND outside any transaction, or a whole
+    BEGIN..COMMIT batch as written by :py:class:`Batcher`. Anything else, such
+    as an ACK or DISCONNECT, belongs to the session it was written in.
+    """
+    end, it = split_frame(pkt, 0, len(pkt))
+    command = next(it, None)
+    if command == b'SEND':
+        return not any(line.startswith(b'transaction:') for line in it)
+    if command == b'BEGIN':
+        last = pkt.rfind(b'\x00', 0, len(pkt) - 1) + 1
+        return pkt.startswith(b'COMMIT\n', last)
+    return False
+
+
+class Spool(object):
+    """
+    Append-only, mmap-backed file of formatted frames waiting to be sent while
+    the server is unreachable. Frames are self-delimiting, so the file is
+    simply their concatenation, preceded by a small header recording the
+    offsets of the unsent region. A spool therefore survives restarts of the
+    process, and is drained in large sequential writes.
+
+    The file is preallocated to `size` bytes, or its existing size if larger.
+    :py:class:`SpoolFull` is raised when an appended frame does not fit.
+    """
+    MAGIC = b'TSP1'
+    _header = struct.Struct('<4sQQ')
+
+    def __init__(self, path, size=64<<20):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.fp = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_size < size:
+            self.fp.truncate(size)
+        self.map = mmap.mmap(fd, 0)
+        magic, self.head, self.tail = self._header.unpack_from(self.map)
+        if magic != self.MAGIC:
+            self.head = self.tail = self._header.size
+            self._save()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def _save(self):
+        self._header.pack_into(self.map, 0, self.MAGIC, self.head, self.tail)
+
+    def _frame_end(self, pos):
+        # Frames were produced by our formatters, so any frame with a body
+        # carries a content-length header.
+        end, it = split_frame(self.map, pos, self.tail)
+        for line in it:
+            if line.startswith(b'content-length:'):
+                end += int(line[15:])
+                break
+        nul_pos = self.map.find(b'\x00', end, self.tail)
+        if not (pos < end <= nul_pos):
+            raise Error('spool is corrupt at offset %d' % pos)
+        return nul_pos + 1
+
+    def compact(self):
+        """
+        Move the unsent region to the start of the file.
+        """
+        start = self._header.size
+        if self.head != start:
+            self.map.move(start, self.head, len(self))
+            self.tail = start + len(self)
+            self.head = start
+            self._save()
+
+    def append(self, s):
+        """
+        Append the formatted frame `s`.
+        """
+        if self.tail + len(s) > len(self.map):
+            self.compact()
+            if self.tail + len(s) > len(self.map):
+                raise SpoolFull('%d byte frame does not fit in spool' % len(s))
+        self.map[self.tail:self.tail+len(s)] = s
+        self.tail += len(s)
+        self._save()
+
+    def drain(self, write, chunk=1<<20):
+        """
+        Write every spooled frame using `write`, a function like
+        :py:meth:`socket.socket.send` that returns the number of bytes it
+        wrote. Frames are written in runs of roughly `chunk` bytes, and each
+        run is only discarded once completely written, so if `write` raises,
+        the next call restarts at a frame boundary.
+        """
+        while self.head < self.tail:
+            end = self.head
+            while end < self.tail and (end - self.head) < chunk:
+                end = self._frame_end(end)
+            pos = self.head
+            while pos < end:
+                pos += write(_buffer(self.map, pos, end - pos))
+            self.head = end
+            self._save()
+        self.head = self.tail = self._header.size
+        self._save()
+
+    def close(self):
+        """
+        Flush the spool to disk and close it.
+        """
+        self.map.flush()
+        self.map.close()
+        self.fp.close()
+
+
+#
+# Tracing.
+#
+
+
+class Histogram(object):
+    """
+    Log-linear histogram of non-negative integers in the style of
+    HdrHistogram. Values below ``2**bits`` are counted exactly, while larger
+    values share buckets whose width is at most ``1/2**(bits-1)`` of their
+    lower bound, so memory grows only with the logarithm of the largest value.
+    """
+    def __init__(self, bits=7):
+        self.bits = bits
+        #: Map of bucket index to count.
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value
+        # value >> shift lies in [half, 2*half), so each shift owns half
+        # consecutive indices, starting after the 2*half exact ones.
+        half = 1 << (self.bits - 1)
+        return shift*half + (value >> shift)
+
+    def _lower(self, index):
+        half = 1 << (self.bits - 1)
+        shift = index // half - 1
+        if shift <= 0:
+            return index
+        return (index - shift*half) << shift
+
+    def record(self, value):
+        """
+        Count one occurrence of `value`.
+        """
+        value = max(0, int(value))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Return the lower bound of the bucket containing the `p`th percentile,
+        or 0 if the histogram is empty.
+        """
+        target = self.count * p / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return self._lower(index)
+        return 0
+
+    def export(self):
+        """
+        Return a sorted list of `(lower_bound, count)` tuples for every
+        non-empty bucket.
+        """
+        return sorted((self._lower(i), n) for i, n in self.counts.items())
+
+
+class Tracer(object):
+    """
+    Break down end-to-end latency of frames sent with tracing enabled, see
+    :py:func:`send`, and received by a :py:class:`Parser` recording
+    timestamps. Three microsecond histograms are kept per destination:
+
+    ``network``
+        From ``trace-sent`` to arrival of the frame. Includes time spent in
+        the broker, and any clock skew between sender and receiver.
+
+    ``parse``
+        From arrival to the end of parsing.
+
+    ``handler``
+        From the end of parsing to the `done` time passed to
+        :py:meth:`record`.
+
+    ::
+
+        c = tinystomp.Client('localhost', trace=True)
+        tracer = tinystomp.Tracer()
+        while True:
+            frame = c.next()
+            handle(frame)
+            tracer.record(frame, time.time())
+    """
+    def __init__(self):
+        #: Map of destination to map of name to :py:class:`Histogram`.
+        self.histograms = {}
+
+    def _histograms(self, destination):
+        hists = self.histograms.get(destination)
+        if hists is None:
+            hists = {
+                'network': Histogram(),
+                'parse': Histogram(),
+                'handler': Histogram(),
+            }
+            self.histograms[destination] = hists
+        return hists
+
+    def record(self, frame, done=None):
+        """
+        Record latencies of `frame`, whose handling completed at `done`. Any
+        interval whose timestamps are missing is skipped.
+        """
+        hists = self._histograms(frame.headers.get(b'destination'))
+        sent = frame.headers.get(b'trace-sent')
+        if sent is not None and frame.arrived is not None:
+            hists['network'].record((frame.arrived - float(sent)) * 1e6)
+        if frame.arrived is not None and frame.parsed is not None:
+            hists['parse'].record((frame.parsed - frame.arrived) * 1e6)
+        if frame.parsed is not None and done is not None:
+            hists['handler'].record((done - frame.parsed) * 1e6)
+
+    def export(self):
+        """
+        Return a map of destination to map of histogram name to the result of
+        :py:meth:`Histogram.export`.
+        """
+        return dict(
+            (destination, dict((k, h.export()) for k, h in hists.items()))
+            for destination, hists in self.histograms.items()
+        )
 
 
 #
@@ -225,28 +726,70 @@ class Parser(object):
     ::
 
         p = tinystomp.Parser()
-        p.receive(tinystomp.send('/foo/bar', 'data', a='1'))
+        p.receive(tinystomp.send('/foo/bar', b'data', a='1'))
         assert p.can_read()
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'data'
+        assert f.command == b'SEND'
+        assert f.body == b'data'
         assert f.headers = {
-            'destination': '/foo/bar',
-            'a': '1',
+            b'destination': b'/foo/bar',
+            b'a': b'1',
         }
+
+    If `timestamps` is ``True``, the :py:attr:`Frame.arrived` and
+    :py:attr:`Frame.parsed` times are recorded for each frame.
+
+    If `decoders` is a map like :py:data:`DECODERS`, frames whose
+    ``content-encoding`` appears in it are returned as
+    :py:class:`EncodedFrame`. Otherwise bodies are returned as received.
     """
-    def __init__(self):
-        self.s = ''
+    def __init__(self, timestamps=False, decoders=None):
+        #: Bytearray of received data not yet parsed into frames.
+        self.s = bytearray()
         self.frames = collections.deque()
+        #: None, or the buffer length needed to complete the frame whose
+        #: headers are saved in :py:attr:`_pending`.
         self.frame_eof = None
+        self.timestamps = timestamps
+        self.decoders = decoders
+        self._scan = 0
+        self._pending = None
+        self._now = None
+        self._arrived = None
 
     def receive(self, s):
         """
-        Consume the bytestring `s`.
+        Consume `s`, which may be a bytestring or any object supporting the
+        buffer protocol, such as a memoryview of a buffer filled by
+        :py:meth:`socket.socket.recv_into`. It is copied exactly once, into
+        the parser's buffer, so it may be reused once this returns.
         """
-        self.s += s
-        while self._try_parse():
-            pass
+        if self.timestamps:
+            self._now = time.time()
+        buf = self.s
+        was_empty = not buf
+        buf += s
+        if was_empty:
+            # Discard heartbeats between frames, so an idle connection cannot
+            # grow the buffer.
+            skip = _eols_pat.match(buf).end()
+            if skip:
+                del buf[:skip]
+                if not buf:
+                    return
+            self._arrived = self._now
+
+        pos = 0
+        while True:
+            end = self._try_parse(pos)
+            if end is None:
+                break
+            pos = end
+        if pos:
+            if self._pending is None:
+                pos = _eols_pat.match(buf, pos).end()
+            del buf[:pos]
+            self._scan = max(0, self._scan - pos)
 
     def can_read(self):
         """
@@ -265,40 +808,77 @@ class Parser(object):
         """
         return self.frames.popleft()
 
-    def _try_parse(self):
-        nul_pos = self.s.find('\x00')
-        if nul_pos == -1 or (self.frame_eof and len(self.s) < self.frame_eof):
-            return
-
-        end, it = split_frame(self.s, 0, nul_pos)
-        try:
-            command = next(it)
-            if not command:
-                # split_frame() guarantees at most one blank prefixing line.
+    def _try_parse(self, start):
+        """
+        Try to parse the frame starting at offset `start` of the buffer,
+        returning the offset following it, or ``None`` if it is incomplete.
+        """
+        s = self.s
+        if self._pending is not None:
+            # Headers were parsed by an earlier call, only the body was
+            # missing.
+            command, headers, end = self._pending
+            end += start
+            nul_pos = start + self.frame_eof - 1
+            if len(s) <= nul_pos:
+                return None
+        else:
+            # No NUL precedes _scan, so avoid searching data again.
+            nul_pos = s.find(b'\x00', max(start, self._scan))
+            if nul_pos == -1:
+                self._scan = len(s)
+                return None
+
+            end, it = split_frame(s, start, nul_pos)
+            try:
                 command = next(it)
-
+                if not command:
+                    # split_frame() guarantees at most one blank prefixing
+                    # line.
+                    command = next(it)
+
+                headers = {}
+                setdefault = headers.setdefault
+
+                for line in it:
+                    key, sep, value = line.partition(b':')
+                    if not sep:
+                        raise ProtocolError('header without colon')
+                    setdefault(key, value)
+            except StopIteration:
+                # Command or end-of-header separator missing.
+                return None
+
+            clength = int(headers.get(b'content-length', b'0'))
+            if clength:
+                # The body may itself contain NULs, so trust content-length
+                # over the first NUL found.
+                nul_pos = end + clength
+                if len(s) <= nul_pos:
+                    self._pending = command, headers, end - start
+                    self.frame_eof = nul_pos + 1 - start
+                    return None
+
+        if s[nul_pos]:
+            raise ProtocolError('frame body longer than content-length')
+
+        body = memoryview(s)[end:nul_pos].tobytes()
+        decoder = self.decoders and \
+            self.decoders.get(headers.get(b'content-encoding'))
+        if decoder:
+            frame = EncodedFrame(command, decoder, body)
+        else:
             frame = Frame(command)
-            setdefault = frame.headers.setdefault
-
-            for line in it:
-                key, sep, value = line.partition(':')
-                if not sep:
-                    raise ProtocolError('header without colon')
-                setdefault(key, value)
-        except StopIteration:
-            # Command or end-of-header separator missing.
-            return False
-
-        clength = int(frame.headers.get('content-length', '0'))
-        if clength == 0 or (end+clength) == nul_pos:
-            frame.body = self.s[end:nul_pos]
-            self.s = self.s[nul_pos+1:]
-            self.frame_eof = None
-            self.frames.append(frame)
-            return True
-
-        self.frame_eof = end + clength
-        return False
+            frame.body = body
+        frame.headers = headers
+        if self.timestamps:
+            frame.arrived = self._arrived
+            frame.parsed = time.time()
+            self._arrived = self._now
+        self._pending = None
+        self.frame_eof = None
+        self.frames.append(frame)
+        return nul_pos + 1
 
 
 class Client(object):
@@ -312,19 +892,58 @@ class Client(object):
         c.connect()
         c.subscribe('/a/b')
         while True:
-            print 'received frame:', c.next()
-
-    A magic :py:meth:`__getattr__` exists that forwards method calls with the
-    same name as a formatter function defined in the tinystomp module on to
-    that function, then sends its result to the server. This way every public
-    formatter function name is also a method name of this class.
+            print('received frame: %r' % (c.next(),))
+
+    Every public formatter function name is also a method name of this class,
+    which formats a frame using that function and passes it to
+    :py:meth:`write`.
+
+    By default every frame is sent immediately. If `bufsize` is nonzero,
+    written frames are instead buffered until `bufsize` bytes are waiting,
+    :py:meth:`flush` is called, or :py:meth:`next` must wait for the server,
+    saving a system call per frame for high rate senders and consumers.
+    Frames still buffered when the client is discarded are lost, so finish
+    with :py:meth:`flush`, :py:meth:`disconnect` or :py:meth:`close`, or use
+    the client as a context manager, which flushes unless its block raises::
+
+        with tinystomp.Client('localhost', bufsize=65536) as c:
+            c.connect()
+            for body in bodies:
+                c.send('/queue/foo', body)
+
+    If `compress` is an integer, :py:meth:`send` compresses bodies longer than
+    that many bytes, and received frames compressed using an encoding in
+    :py:data:`DECODERS` are decompressed when their body is first accessed.
+
+    If `spool` is a :py:class:`Spool`, SEND frames and whole transactions
+    written by :py:class:`Batcher` while disconnected are appended to it, and
+    it is drained by the next :py:meth:`connect`. Other frames written while
+    disconnected, such as ACK or DISCONNECT, only make sense in the session
+    they were written for, so they are dropped. If the connection fails during
+    a write, only frames the socket had not completely accepted are spooled,
+    so frames accepted but lost in transit are not replayed.
+
+    If `trace` is ``True``, :py:meth:`send` adds tracing headers, and received
+    frames carry timestamps for use with :py:class:`Tracer`.
     """
-    def __init__(self, host=None, port=None, login=None, passcode=None):
+    #: None, or the connected socket.
+    s = None
+
+    def __init__(self, host=None, port=None, login=None, passcode=None,
+                 compress=None, spool=None, trace=False, bufsize=0):
         self.host = host
         self.port = port
         self.login = login
         self.passcode = passcode
-        self.parser = Parser()
+        self.compress = compress
+        self.spool = spool
+        self.trace = trace
+        self.bufsize = bufsize
+        self.parser = Parser(timestamps=trace,
+                             decoders=None if compress is None else DECODERS)
+        self.rbuf = bytearray(4096)
+        self.buf = []
+        self.buffered = 0
 
     @classmethod
     def from_url(cls, url, **kwargs):
@@ -344,24 +963,259 @@ class Client(object):
         if self.login or self.passcode:
             extra = {'login': self.login or '',
                      'passcode': self.passcode or ''}
-        self.s.send(connect(self.host, **extra))
+        self._sendall(connect(self.host, **extra))
+        if self.spool is not None and len(self.spool):
+            self.spool.drain(self.s.send)
 
     def next(self):
         """
         Block waiting for the next available frame, returning it when received.
+        Buffered frames are flushed before waiting.
         """
+        view = memoryview(self.rbuf)
         while not self.parser.can_read():
-            s = self.s.recv(4096)
-            if not s:
+            self.flush()
+            if self.s is None:
+                raise ProtocolError('disconnected')
+            n = self.s.recv_into(self.rbuf)
+            if not n:
                 raise ProtocolError('disconnected')
-            self.parser.receive(s)
+            self.parser.receive(view[:n])
         return self.parser.next()
 
-    def __getattr__(self, k):
-        formatter = globals().get(k)
+    def send(self, destination, body=None, **headers):
+        """
+        Generate a SEND frame and send it to the server, compressing its body
+        according to :py:attr:`compress` and tracing it according to
+        :py:attr:`trace`. Pass `compress_` or `trace_` to override them for
+        one frame; see :py:func:`send`.
+        """
+        headers.setdefault('compress_', self.compress)
+        headers.setdefault('trace_', self.trace)
+        self.write(send(destination, body, **headers))
+
+    def disconnect(self, receipt, **headers):
+        """
+        Generate a DISCONNECT frame and send it to the server, along with any
+        buffered frames.
+        """
+        self.write(disconnect(receipt, **headers))
+        self.flush()
+
+    def close(self):
+        """
+        Send any buffered frames to the server, then close the connection.
+        """
+        try:
+            self.flush()
+        finally:
+            if self.s is not None:
+                self._close_socket()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # If the block raised, flushing could replace its exception with a
+        # socket error, so buffered frames are discarded instead.
+        if exc_type is None:
+            self.close()
+        elif self.s is not None:
+            self._close_socket()
+
+    def write(self, pkt):
+        """
+        Buffer the formatted frame `pkt`, flushing the buffer if it has grown
+        beyond :py:attr:`bufsize`.
+        """
+        self.buf.append(pkt)
+        self.buffered += len(pkt)
+        if self.buffered >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Send any buffered frames to the server. If a spool is configured and
+        the connection is down or the spool is not yet drained, append those
+        that may be replayed to the spool instead.
+        """
+        if not self.buf:
+            return
+        frames = self.buf
+        self.buf = []
+        self.buffered = 0
+
+        if self.spool is None:
+            self._sendall(b''.join(frames))
+        elif self.s is None or len(self.spool):
+            self._spool(frames)
+        else:
+            pkt = b''.join(frames)
+            sent = self._send(pkt)
+            if sent < len(pkt):
+                self._close_socket()
+                # Frames that were completely written are not replayed. The
+                # server discards the partly written one with the session.
+                for i, frame in enumerate(frames):
+                    sent -= len(frame)
+                    if sent < 0:
+                        self._spool(frames[i:])
+                        break
+
+    def _spool(self, frames):
+        pkt = b''.join(pkt for pkt in frames if _spoolable(pkt))
+        if pkt:
+            self.spool.append(pkt)
+
+    def _close_socket(self):
+        sock, self.s = self.s, None
+        sock.close()
+
+    def _send(self, pkt):
+        """
+        Send as much of `pkt` as possible, returning the number of bytes
+        written before any socket error.
+        """
+        view = memoryview(pkt)
+        pos = 0
+        while pos < len(pkt):
+            try:
+                pos += self.s.send(view[pos:])
+            except socket.error as e:
+                if e.errno != errno.EINTR:
+                    break
+        return pos
+
+    def _sendall(self, pkt):
+        if self.s is None:
+            raise ProtocolError('disconnected')
+        self.s.sendall(pkt)
+
+
+def _client_method(formatter):
+    @functools.wraps(formatter)
+    def method(self, *args, **kwargs):
+        self.write(formatter(*args, **kwargs))
+    return method
+
+
+for _name in 'subscribe', 'unsubscribe', 'ack', 'nack', 'begin', 'commit', \
+             'abort':
+    setattr(Client, _name, _client_method(globals()[_name]))
+del _name
 
-        @functools.wraps(formatter)
-        def wrapper(*args, **kwargs):
-            pkt = formatter(*args, **kwargs)
-            self.s.send(pkt)
-        return wrapper
+
+class Consumer(object):
+    """
+    Consume one destination through a :py:class:`Client`, adapting the
+    ActiveMQ prefetch window to the speed of `handler`.
+
+    ::
+
+        c = tinystomp.Client('localhost', bufsize=65536)
+        c.connect()
+        tinystomp.Consumer(c, '/queue/foo', handle_message).run()
+
+    Messages are requested with ``client-individual`` acknowledgement, so the
+    broker holds back new messages while ``activemq.prefetchSize`` remain
+    unacknowledged, and each ACK returns one credit. A moving average of
+    handler latency is kept, and the prefetch is resized so a full window is
+    handled within `target` seconds, bounding both the delay before a message
+    is handled and the memory a slow consumer can hoard. Resizing means
+    resubscribing, which causes the broker to redeliver all unacknowledged
+    messages, so it only happens when the ideal size has at least doubled or
+    halved, and is deferred while messages for the old subscription are still
+    queued locally.
+
+    Only ``/queue/`` destinations are resized. Other destinations, such as
+    topics, do not redeliver messages to a new subscription, so resizing
+    would lose them; their prefetch stays fixed at `max_prefetch`.
+
+    :py:meth:`Client.next` only reads the socket once its queue of parsed
+    frames is empty, so reading is paused while a backlog exists.
+    """
+    #: Weight given to each new handler latency sample.
+    alpha = 0.1
+    #: Subscription ID in use, or ``None`` before :py:meth:`subscribe`.
+    id = None
+    #: Moving average handler latency in seconds, or ``None``.
+    latency = None
+
+    def __init__(self, client, destination, handler, target=0.1,
+                 min_prefetch=1, max_prefetch=1000, **headers):
+        self.client = client
+        self.destination = destination
+        self.handler = handler
+        self.target = target
+        self.min_prefetch = min_prefetch
+        self.max_prefetch = max_prefetch
+        self.headers = headers
+        #: ``True`` if the prefetch size may be adapted.
+        self.adaptive = _encode(destination).startswith(b'/queue/')
+        self.prefetch = min_prefetch if self.adaptive else max_prefetch
+        self.prefix = str(time.time())
+        self._ids = itertools.count()
+
+    def subscribe(self):
+        """
+        Subscribe using the current prefetch size, replacing any existing
+        subscription.
+        """
+        if self.id is not None:
+            self.client.unsubscribe(self.destination, self.id)
+        self.id = _encode('%s-%d' % (self.prefix, next(self._ids)))
+        headers = dict(self.headers, id=self.id, ack='client-individual')
+        headers['activemq.prefetchSize'] = str(self.prefetch)
+        self.client.subscribe(self.destination, **headers)
+
+    def handle(self, frame):
+        """
+        Pass a frame received by the client to the handler and acknowledge it,
+        if it is a message for the current subscription. Messages for earlier
+        subscriptions are dropped, since the broker redelivers them.
+
+        :returns:
+            ``True`` if the frame was handled.
+        """
+        if frame.command == b'ERROR':
+            raise ProtocolError(frame.headers.get(b'message', b'ERROR frame'))
+        headers = frame.headers
+        if (frame.command != b'MESSAGE' or
+                headers.get(b'subscription') != self.id):
+            return False
+
+        start = time.time()
+        self.handler(frame)
+        elapsed = time.time() - start
+
+        message_id = headers.get(b'message-id')
+        self.client.ack(headers.get(b'ack', message_id),
+                        message_id=message_id, subscription=self.id)
+
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += self.alpha * (elapsed - self.latency)
+        self._adapt()
+        return True
+
+    def _adapt(self):
+        if not self.adaptive:
+            return
+        want = int(self.target / max(self.latency, 1e-6))
+        want = max(self.min_prefetch, min(self.max_prefetch, want))
+        if ((want >= self.prefetch*2 or want*2 <= self.prefetch)
+                and not self.client.parser.can_read()):
+            self.prefetch = want
+            self.subscribe()
+
+    def run(self, count=None):
+        """
+        Subscribe if necessary, then handle messages forever, or until `count`
+        messages have been handled.
+        """
+        if self.id is None:
+            self.subscribe()
+        handled = 0
+        while count is None or handled < count:
+            handled += self.handle(self.client.next())
@@ -20,13 +20,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import array
 import collections
+import errno
+import os
+import shutil
+import socket
+import tempfile
+import time
 import unittest
-import mock
+import zlib
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import tinystomp
 
 
+def tobytes(buf):
+    # bytes() of a memoryview is its repr on Python 2.
+    return bytes(bytearray(buf))
+
+
 class ErrorTest(unittest.TestCase):
     def test_constructor(self):
         tinystomp.Error()
@@ -37,22 +54,85 @@ class ProtocolErrorTest(unittest.TestCase):
         tinystomp.ProtocolError()
 
 
+class SpoolFullTest(unittest.TestCase):
+    def test_constructor(self):
+        tinystomp.SpoolFull()
+
+
 class FrameTest(unittest.TestCase):
     def test_constructor(self):
-        f = tinystomp.Frame('cmd')
-        assert 'cmd' == f.command
+        f = tinystomp.Frame(b'cmd')
+        assert b'cmd' == f.command
         assert {} == f.headers
 
     def test_repr(self):
-        f = tinystomp.Frame('cmd')
+        f = tinystomp.Frame(b'cmd')
         assert "<cmd None {\n    \n}>" == repr(f)
 
     def test_repr_headers(self):
-        f = tinystomp.Frame('cmd')
-        f.headers['a'] = 'b'
+        f = tinystomp.Frame(b'cmd')
+        f.headers[b'a'] = b'b'
         assert "<cmd None {\n    a b\n}>" == repr(f)
 
 
+class EncodedFrameTest(unittest.TestCase):
+    def test_constructor(self):
+        f = tinystomp.EncodedFrame(b'cmd', zlib.decompress, b'x')
+        assert b'cmd' == f.command
+        assert {} == f.headers
+        assert b'x' == f.raw_body
+
+    def test_body_lazy(self):
+        decoder = mock.Mock(return_value=b'dave')
+        f = tinystomp.EncodedFrame(b'cmd', decoder, b'x')
+        assert decoder.mock_calls == []
+        assert f.body == b'dave'
+        assert f.body == b'dave'
+        assert decoder.mock_calls == [mock.call(b'x')]
+
+    def test_body_setter(self):
+        decoder = mock.Mock()
+        f = tinystomp.EncodedFrame(b'cmd', decoder, b'x')
+        f.body = None
+        assert f.body is None
+        assert decoder.mock_calls == []
+
+    def test_body_error(self):
+        f = tinystomp.EncodedFrame(b'cmd', tinystomp.DECODERS[b'deflate'],
+                                   b'\xffjunk')
+        self.assertRaises(tinystomp.ProtocolError, lambda: f.body)
+        self.assertRaises(tinystomp.ProtocolError, lambda: f.body)
+        assert f.raw_body == b'\xffjunk'
+
+    def test_repr_not_decoded(self):
+        decoder = mock.Mock(return_value=b'dave')
+        f = tinystomp.EncodedFrame(b'cmd', decoder, b'x')
+        assert "<cmd %r {\n    \n}>" % (b'x..', ) == repr(f)
+        assert decoder.mock_calls == []
+        f.body
+        assert "<cmd %r {\n    \n}>" % (b'dave..', ) == repr(f)
+
+
+class InflateTest(unittest.TestCase):
+    func = staticmethod(tinystomp.DECODERS[b'deflate'])
+
+    def test_zlib(self):
+        assert self.func(zlib.compress(b'dave' * 100)) == b'dave' * 100
+
+    def test_raw(self):
+        obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = obj.compress(b'dave' * 100) + obj.flush()
+        assert self.func(raw) == b'dave' * 100
+
+    def test_invalid(self):
+        self.assertRaises(tinystomp.ProtocolError, self.func, b'\xffjunk')
+
+    @mock.patch('tinystomp.MAX_DECODED_SIZE', 399)
+    def test_too_large(self):
+        self.assertRaises(tinystomp.ProtocolError, self.func,
+                          zlib.compress(b'dave' * 100))
+
+
 class ParseUrlTest(unittest.TestCase):
     def test_parse_url(self):
         h, p = tinystomp.parse_url('tcp://host:1234/')
@@ -66,57 +146,57 @@ class SplitFrameTest(unittest.TestCase):
         return end, list(it)
 
     def test_empty(self):
-        assert (0, []) == self.func('', 0, 0)
+        assert (0, []) == self.func(b'', 0, 0)
 
     def test_oob(self):
-        assert (0, []) == self.func('dave\n', 5, 0)
+        assert (0, []) == self.func(b'dave\n', 5, 0)
 
     def test_offset(self):
-        assert (6, ['ave']) == self.func('dave\n\n', 1, 6)
+        assert (6, [b'ave']) == self.func(b'dave\n\n', 1, 6)
 
     def test_several(self):
-        s = '\ndave\ndave\n\n'
+        s = b'\ndave\ndave\n\n'
         assert self.func(s, 0, len(s)) == (12, [
-            '',
-            'dave',
-            'dave',
+            b'',
+            b'dave',
+            b'dave',
         ])
 
     def test_prefix_eol_pairs_odd(self):
-        s = '\n\r\n\r\n\n\r\ndave\n\n'
-        assert self.func(s, 0, len(s)) == (14, ['', 'dave'])
+        s = b'\n\r\n\r\n\n\r\ndave\n\n'
+        assert self.func(s, 0, len(s)) == (14, [b'', b'dave'])
 
     def test_prefix_eol_pairs_even(self):
-        s = '\n\n\r\n\r\n\n\r\ndave\n\n'
-        assert self.func(s, 0, len(s)) == (15, ['dave'])
+        s = b'\n\n\r\n\r\n\n\r\ndave\n\n'
+        assert self.func(s, 0, len(s)) == (15, [b'dave'])
 
 
 class FormatTest(unittest.TestCase):
     def test_nobody_noheaders(self):
-        s = tinystomp._format('cmd', None, {})
-        assert 'cmd\n\n\x00' == s
+        s = tinystomp._format(b'cmd', None, {})
+        assert b'cmd\n\n\x00' == s
 
     def test_nobody_headers(self):
-        s = tinystomp._format('cmd', None, {
-            'a': 'b',
+        s = tinystomp._format(b'cmd', None, {
+            'a': b'b',
         })
-        assert 'cmd\na:b\n\n\x00' == s
+        assert b'cmd\na:b\n\n\x00' == s
 
     def test_body_headers(self):
-        s = tinystomp._format('cmd', 'dave', {
-            'a': 'b',
+        s = tinystomp._format(b'cmd', b'dave', {
+            'a': b'b',
         })
         assert s == (
-            'cmd\n'
-            'content-length:4\n'
-            'a:b\n'
-            '\n'
-            'dave'
-            '\x00'
+            b'cmd\n'
+            b'content-length:4\n'
+            b'a:b\n'
+            b'\n'
+            b'dave'
+            b'\x00'
         )
 
     def assertParse(self, s, cmd, body, headers):
-        p = tinystomp.Parser()
+        p = tinystomp.Parser(decoders=tinystomp.DECODERS)
         p.receive(s)
         f = p.next()
         assert f.command == cmd
@@ -124,93 +204,477 @@ class FormatTest(unittest.TestCase):
         assert sorted(f.headers.items()) == sorted(headers.items())
 
     def test_connect(self):
-        s = tinystomp.connect('localhost', a='b')
-        self.assertParse(s, 'CONNECT', '', {
-            'a': 'b',
-            'accept-version': '1.0,1.1,1.2',
-            'host': 'localhost'
+        s = tinystomp.connect(b'localhost', a=b'b')
+        self.assertParse(s, b'CONNECT', b'', {
+            b'a': b'b',
+            b'accept-version': b'1.0,1.1,1.2',
+            b'host': b'localhost'
         })
 
     def test_send_nobody(self):
-        s = tinystomp.send('/foo/bar', a='b')
-        self.assertParse(s, 'SEND', '', {
-            'a': 'b',
-            'destination': '/foo/bar'
+        s = tinystomp.send(b'/foo/bar', a=b'b')
+        self.assertParse(s, b'SEND', b'', {
+            b'a': b'b',
+            b'destination': b'/foo/bar'
         })
 
     def test_send_body(self):
-        s = tinystomp.send('/foo/bar', 'dave', a='b')
-        self.assertParse(s, 'SEND', 'dave', {
-            'a': 'b',
-            'content-length': '4',
-            'destination': '/foo/bar'
+        s = tinystomp.send(b'/foo/bar', b'dave', a=b'b')
+        self.assertParse(s, b'SEND', b'dave', {
+            b'a': b'b',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar'
+        })
+
+    @unittest.skipIf(bytes is str, 'requires Python 3')
+    def test_send_buffer_body(self):
+        for body in bytearray(b'dave'), memoryview(b'dave'):
+            s = tinystomp.send(b'/foo/bar', body)
+            self.assertParse(s, b'SEND', b'dave', {
+                b'content-length': b'4',
+                b'destination': b'/foo/bar'
+            })
+
+    def test_send_buffer_headers(self):
+        for cls in bytearray, memoryview:
+            s = tinystomp.send(cls(b'/foo/bar'), a=cls(b'b'))
+            self.assertParse(s, b'SEND', b'', {
+                b'a': b'b',
+                b'destination': b'/foo/bar'
+            })
+
+    def test_send_text(self):
+        s = tinystomp.send(u'/foo/b\xe4r', u'd\xe4ve', a=u'\xe4')
+        self.assertParse(s, b'SEND', b'd\xc3\xa4ve', {
+            b'a': b'\xc3\xa4',
+            b'content-length': b'5',
+            b'destination': b'/foo/b\xc3\xa4r'
+        })
+
+    def test_send_compress_below_threshold(self):
+        s = tinystomp.send(b'/foo/bar', b'dave', compress_=4)
+        self.assertParse(s, b'SEND', b'dave', {
+            b'content-length': b'4',
+            b'destination': b'/foo/bar'
+        })
+
+    def test_send_compress_incompressible(self):
+        s = tinystomp.send(b'/foo/bar', b'dave', compress_=0)
+        self.assertParse(s, b'SEND', b'dave', {
+            b'content-length': b'4',
+            b'destination': b'/foo/bar'
+        })
+
+    def test_send_compress_text(self):
+        s = tinystomp.send(b'/foo/bar', u'dave' * 100, compress_=10)
+        self.assertParse(s, b'SEND', b'dave' * 100, {
+            b'content-encoding': b'deflate',
+            b'content-length': str(len(zlib.compress(b'dave' * 100))).encode(),
+            b'destination': b'/foo/bar'
+        })
+
+    def test_send_compress(self):
+        body = b'dave' * 100
+        zbody = zlib.compress(body)
+        s = tinystomp.send(b'/foo/bar', body, compress_=10)
+        self.assertParse(s, b'SEND', body, {
+            b'content-encoding': b'deflate',
+            b'content-length': str(len(zbody)).encode(),
+            b'destination': b'/foo/bar'
+        })
+
+    @unittest.skipIf(bytes is str, 'requires Python 3')
+    def test_send_compress_wide_buffer(self):
+        body = memoryview(array.array('i', [0] * 100))
+        zbody = zlib.compress(body)
+        s = tinystomp.send(b'/foo/bar', body, compress_=200)
+        self.assertParse(s, b'SEND', body.tobytes(), {
+            b'content-encoding': b'deflate',
+            b'content-length': str(len(zbody)).encode(),
+            b'destination': b'/foo/bar'
+        })
+
+    @mock.patch('random.getrandbits')
+    @mock.patch('time.time')
+    def test_send_trace(self, time, getrandbits):
+        time.return_value = 1.5
+        getrandbits.return_value = 0xabc
+        s = tinystomp.send(b'/foo/bar', trace_=True)
+        self.assertParse(s, b'SEND', b'', {
+            b'destination': b'/foo/bar',
+            b'trace-id': b'0000000000000abc',
+            b'trace-sent': b'1.500000',
+        })
+
+    def test_send_option_names_are_headers(self):
+        s = tinystomp.send(b'/foo/bar', b'dave', compress=b'yes', trace=b'no')
+        self.assertParse(s, b'SEND', b'dave', {
+            b'compress': b'yes',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar',
+            b'trace': b'no',
         })
 
     def test_subscribe(self):
-        s = tinystomp.subscribe('/foo/bar', id=123, a='b')
-        self.assertParse(s, 'SUBSCRIBE', '', {
-            'a': 'b',
-            'destination': '/foo/bar',
-            'id': '123',
+        s = tinystomp.subscribe(b'/foo/bar', id=123, a=b'b')
+        self.assertParse(s, b'SUBSCRIBE', b'', {
+            b'a': b'b',
+            b'destination': b'/foo/bar',
+            b'id': b'123',
         })
 
     def test_unsubscribe(self):
-        s = tinystomp.unsubscribe('/foo/bar', 123, a='b')
-        self.assertParse(s, 'UNSUBSCRIBE', '', {
-            'a': 'b',
-            'destination': '/foo/bar',
-            'id': '123',
+        s = tinystomp.unsubscribe(b'/foo/bar', 123, a=b'b')
+        self.assertParse(s, b'UNSUBSCRIBE', b'', {
+            b'a': b'b',
+            b'destination': b'/foo/bar',
+            b'id': b'123',
         })
 
     def test_ack(self):
-        s = tinystomp.ack('123', a='b')
-        self.assertParse(s, 'ACK', '', {
-            'a': 'b',
-            'id': '123',
+        s = tinystomp.ack(b'123', a=b'b')
+        self.assertParse(s, b'ACK', b'', {
+            b'a': b'b',
+            b'id': b'123',
         })
 
     def test_nack(self):
-        s = tinystomp.nack('123', a='b')
-        self.assertParse(s, 'NACK', '', {
-            'a': 'b',
-            'id': '123',
+        s = tinystomp.nack(b'123', a=b'b')
+        self.assertParse(s, b'NACK', b'', {
+            b'a': b'b',
+            b'id': b'123',
         })
 
     def test_begin(self):
-        s = tinystomp.begin('123', a='b')
-        self.assertParse(s, 'BEGIN', '', {
-            'a': 'b',
-            'transaction': '123',
+        s = tinystomp.begin(b'123', a=b'b')
+        self.assertParse(s, b'BEGIN', b'', {
+            b'a': b'b',
+            b'transaction': b'123',
         })
 
     def test_commit(self):
-        s = tinystomp.commit('123', a='b')
-        self.assertParse(s, 'COMMIT', '', {
-            'a': 'b',
-            'transaction': '123',
+        s = tinystomp.commit(b'123', a=b'b')
+        self.assertParse(s, b'COMMIT', b'', {
+            b'a': b'b',
+            b'transaction': b'123',
         })
 
     def test_abort(self):
-        s = tinystomp.abort('123', a='b')
-        self.assertParse(s, 'ABORT', '', {
-            'a': 'b',
-            'transaction': '123',
+        s = tinystomp.abort(b'123', a=b'b')
+        self.assertParse(s, b'ABORT', b'', {
+            b'a': b'b',
+            b'transaction': b'123',
         })
 
     def test_disconnect(self):
-        s = tinystomp.disconnect('123', a='b')
-        self.assertParse(s, 'DISCONNECT', '', {
-            'a': 'b',
-            'receipt': '123',
+        s = tinystomp.disconnect(b'123', a=b'b')
+        self.assertParse(s, b'DISCONNECT', b'', {
+            b'a': b'b',
+            b'receipt': b'123',
         })
 
 
+class BatcherTest(unittest.TestCase):
+    def test_constructor(self):
+        write = mock.Mock()
+        b = tinystomp.Batcher(write, 10, 2.0, 'p')
+        assert b.write is write
+        assert b.size == 10
+        assert b.interval == 2.0
+        assert b.prefix == 'p'
+        assert b.frames == []
+        assert b.transaction is None
+
+    def test_flush_empty(self):
+        write = mock.Mock()
+        tinystomp.Batcher(write).flush()
+        assert write.mock_calls == []
+
+    def test_flush_size(self):
+        write = mock.Mock()
+        b = tinystomp.Batcher(write, size=2, prefix='p')
+        b.send(b'/foo/bar', b'a')
+        assert write.mock_calls == []
+        b.send(b'/foo/bar', b'b', a=b'b')
+        assert write.mock_calls == [mock.call(
+            tinystomp.begin(b'p-0') +
+            tinystomp.send(b'/foo/bar', b'a', transaction=b'p-0') +
+            tinystomp.send(b'/foo/bar', b'b', a=b'b', transaction=b'p-0') +
+            tinystomp.commit(b'p-0')
+        )]
+        assert b.transaction is None
+        assert b.frames == []
+
+    @mock.patch('time.time')
+    def test_flush_interval(self, time):
+        time.return_value = 100.0
+        write = mock.Mock()
+        b = tinystomp.Batcher(write, interval=1.0, prefix='p')
+        b.send(b'/foo/bar', b'a')
+        assert write.mock_calls == []
+        time.return_value = 101.0
+        b.send(b'/foo/bar', b'b')
+        assert len(write.mock_calls) == 1
+
+    def test_flush_explicit(self):
+        write = mock.Mock()
+        b = tinystomp.Batcher(write, prefix='p')
+        b.send(b'/foo/bar', b'a')
+        b.flush()
+        b.send(b'/foo/bar', b'b')
+        b.flush()
+        assert write.mock_calls == [
+            mock.call(tinystomp.begin(b'p-0') +
+                      tinystomp.send(b'/foo/bar', b'a', transaction=b'p-0') +
+                      tinystomp.commit(b'p-0')),
+            mock.call(tinystomp.begin(b'p-1') +
+                      tinystomp.send(b'/foo/bar', b'b', transaction=b'p-1') +
+                      tinystomp.commit(b'p-1')),
+        ]
+
+    def test_flush_write_error(self):
+        write = mock.Mock(side_effect=[socket.error(), None])
+        b = tinystomp.Batcher(write, prefix='p')
+        b.send(b'/foo/bar', b'a')
+        self.assertRaises(socket.error, b.flush)
+        assert b.transaction == 'p-0'
+        b.flush()
+        pkt = (tinystomp.begin('p-0') +
+               tinystomp.send(b'/foo/bar', b'a', transaction='p-0') +
+               tinystomp.commit('p-0'))
+        assert write.mock_calls == [mock.call(pkt), mock.call(pkt)]
+        assert b.transaction is None
+
+    def test_abort(self):
+        write = mock.Mock()
+        b = tinystomp.Batcher(write)
+        b.send(b'/foo/bar', b'a')
+        b.abort()
+        b.flush()
+        assert write.mock_calls == []
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def frames(self, n):
+        return [tinystomp.send(b'/foo/bar', b'da\x00ve%d' % i) for i in range(n)]
+
+    def written(self, write):
+        # drain() passes zero-copy views of the map.
+        return [tobytes(call[1][0]) for call in write.mock_calls]
+
+    def test_constructor(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        assert os.path.getsize(self.path) == 4096
+        assert len(spool) == 0
+        spool.close()
+
+    def test_drain(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        frames = self.frames(3) + [tinystomp.ack(b'123')]
+        for frame in frames:
+            spool.append(frame)
+        assert len(spool) == len(b''.join(frames))
+        write = mock.Mock(side_effect=len)
+        spool.drain(write)
+        assert self.written(write) == [b''.join(frames)]
+        assert len(spool) == 0
+
+    def test_drain_short_writes(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        frames = self.frames(3)
+        for frame in frames:
+            spool.append(frame)
+        out = []
+        def write(s):
+            out.append(tobytes(s[:5]))
+            return len(out[-1])
+        spool.drain(write)
+        assert b''.join(out) == b''.join(frames)
+
+    def test_drain_chunks(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        frames = self.frames(3)
+        for frame in frames:
+            spool.append(frame)
+        write = mock.Mock(side_effect=len)
+        spool.drain(write, chunk=1)
+        assert self.written(write) == frames
+
+    def test_drain_error_restarts_chunk(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        frames = self.frames(3)
+        for frame in frames:
+            spool.append(frame)
+        write = mock.Mock(side_effect=[len(frames[0]), 3, socket.error()])
+        self.assertRaises(socket.error, spool.drain, write, chunk=1)
+        assert len(spool) == len(frames[1] + frames[2])
+        write = mock.Mock(side_effect=len)
+        spool.drain(write)
+        assert self.written(write) == [frames[1] + frames[2]]
+
+    def test_reopen(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        spool.append(tinystomp.ack(b'123'))
+        spool.close()
+        spool = tinystomp.Spool(self.path, 4096)
+        write = mock.Mock(side_effect=len)
+        spool.drain(write)
+        assert self.written(write) == [tinystomp.ack(b'123')]
+
+    def test_full(self):
+        spool = tinystomp.Spool(self.path, 64)
+        self.assertRaises(tinystomp.SpoolFull, spool.append, b'x' * 64)
+
+    def test_compact(self):
+        frame = tinystomp.send(b'/foo/bar', b'x' * 10)
+        spool = tinystomp.Spool(self.path, 20 + len(frame) * 2)
+        spool.append(frame)
+        spool.append(frame)
+        write = mock.Mock(side_effect=[len(frame), socket.error()])
+        self.assertRaises(socket.error, spool.drain, write, chunk=1)
+        spool.append(frame)
+        write = mock.Mock(side_effect=len)
+        spool.drain(write)
+        assert self.written(write) == [frame * 2]
+
+    def test_spoolable(self):
+        assert tinystomp._spoolable(tinystomp.send(b'/foo/bar', b'a'))
+        assert not tinystomp._spoolable(
+            tinystomp.send(b'/foo/bar', b'a', transaction=b'tx'))
+        assert tinystomp._spoolable(
+            tinystomp.begin(b'tx') +
+            tinystomp.send(b'/foo/bar', b'a', transaction=b'tx') +
+            tinystomp.commit(b'tx'))
+        assert not tinystomp._spoolable(tinystomp.begin(b'tx'))
+        assert not tinystomp._spoolable(tinystomp.commit(b'tx'))
+        for frame in (tinystomp.ack(b'1'), tinystomp.nack(b'1'),
+                      tinystomp.subscribe(b'/foo/bar'),
+                      tinystomp.unsubscribe(b'/foo/bar', b'1'),
+                      tinystomp.disconnect(b'1')):
+            assert not tinystomp._spoolable(frame)
+
+    def test_corrupt(self):
+        spool = tinystomp.Spool(self.path, 4096)
+        spool.append(b'junk')
+        self.assertRaises(tinystomp.Error, spool.drain, mock.Mock())
+
+
+class HistogramTest(unittest.TestCase):
+    def test_constructor(self):
+        h = tinystomp.Histogram(5)
+        assert h.bits == 5
+        assert h.counts == {}
+        assert h.count == 0
+        assert h.max == 0
+
+    def test_exact(self):
+        h = tinystomp.Histogram(5)
+        for v in 0, 1, 31, 31:
+            h.record(v)
+        assert h.export() == [(0, 1), (1, 1), (31, 2)]
+
+    def test_buckets(self):
+        h = tinystomp.Histogram(5)
+        for v in 32, 33, 64, 67, 1000000:
+            h.record(v)
+        assert h.export() == [(32, 2), (64, 2), (983040, 1)]
+        assert h.max == 1000000
+
+    def test_bucket_error(self):
+        h = tinystomp.Histogram(5)
+        for v in range(100000):
+            lower = h._lower(h._index(v))
+            assert lower <= v <= lower * 17 / 16.0
+
+    def test_negative(self):
+        h = tinystomp.Histogram()
+        h.record(-5)
+        assert h.export() == [(0, 1)]
+
+    def test_percentile(self):
+        h = tinystomp.Histogram()
+        assert h.percentile(50) == 0
+        for v in range(100):
+            h.record(v)
+        assert h.percentile(50) == 49
+        assert h.percentile(99) == 98
+        assert h.percentile(100) == 99
+
+
+class TracerTest(unittest.TestCase):
+    def frame(self, **kwargs):
+        f = tinystomp.Frame(b'MESSAGE')
+        f.headers[b'destination'] = b'/foo/bar'
+        f.headers[b'trace-sent'] = b'1.000000'
+        for k, v in kwargs.items():
+            setattr(f, k, v)
+        return f
+
+    def test_constructor(self):
+        assert tinystomp.Tracer().histograms == {}
+
+    def test_record(self):
+        t = tinystomp.Tracer()
+        t.record(self.frame(arrived=1.5, parsed=1.75), 2.0)
+        assert t.export() == {
+            b'/foo/bar': {
+                'network': [(499712, 1)],
+                'parse': [(249856, 1)],
+                'handler': [(249856, 1)],
+            }
+        }
+
+    def test_record_missing(self):
+        t = tinystomp.Tracer()
+        f = self.frame()
+        del f.headers[b'trace-sent']
+        t.record(f)
+        assert t.export() == {
+            b'/foo/bar': {
+                'network': [],
+                'parse': [],
+                'handler': [],
+            }
+        }
+
+
 class ParserTest(unittest.TestCase):
     def test_constructor(self):
         p = tinystomp.Parser()
-        assert p.s == ''
+        assert p.s == b''
         assert p.frames == collections.deque()
         assert p.frame_eof is None
+        assert not p.timestamps
+
+
+class ParserTimestampsTest(unittest.TestCase):
+    @mock.patch('time.time')
+    def test_timestamps(self, time):
+        p = tinystomp.Parser(timestamps=True)
+        s = tinystomp.send(b'/foo/bar', b'dave')
+        time.side_effect = [1.0, 2.0, 3.0]
+        p.receive(s[:5])
+        p.receive(s[5:] + s[:5])
+        f = p.next()
+        assert (f.arrived, f.parsed) == (1.0, 3.0)
+        time.side_effect = [4.0, 5.0]
+        p.receive(s[5:])
+        f = p.next()
+        assert (f.arrived, f.parsed) == (2.0, 5.0)
+
+    def test_no_timestamps(self):
+        p = tinystomp.Parser()
+        p.receive(tinystomp.send(b'/foo/bar', b'dave'))
+        f = p.next()
+        assert f.arrived is None
+        assert f.parsed is None
 
 
 class ParserComplianceTest(unittest.TestCase):
@@ -218,164 +682,164 @@ class ParserComplianceTest(unittest.TestCase):
         # STOMP 1.2 "Repeated Header Entries" requires only the first header is
         # preserved.
         p = tinystomp.Parser()
-        p.receive('SEND\r\n'
-                  'key:value1\r\n'
-                  'key:value2\r\n'
-                  '\r\n'
-                  '\x00')
+        p.receive(b'SEND\r\n'
+                  b'key:value1\r\n'
+                  b'key:value2\r\n'
+                  b'\r\n'
+                  b'\x00')
 
         f = p.next()
-        assert f.headers['key'] == 'value1'
+        assert f.headers[b'key'] == b'value1'
 
 
 class ParserReceiveTest(unittest.TestCase):
     def test_empty_str(self):
         p = tinystomp.Parser()
-        p.receive('')
+        p.receive(b'')
         assert not p.can_read()
 
     def test_one_nobody(self):
         p = tinystomp.Parser()
-        p.receive(tinystomp.connect('host'))
+        p.receive(tinystomp.connect(b'host'))
         assert p.can_read()
         f = p.next()
-        assert f.command == 'CONNECT'
-        assert f.body == ''
+        assert f.command == b'CONNECT'
+        assert f.body == b''
         assert f.headers == {
-            'accept-version': '1.0,1.1,1.2',
-            'host': 'host'
+            b'accept-version': b'1.0,1.1,1.2',
+            b'host': b'host'
         }
 
     def test_one_body(self):
         p = tinystomp.Parser()
-        p.receive(tinystomp.send('/foo/bar', 'dave', a='b'))
+        p.receive(tinystomp.send(b'/foo/bar', b'dave', a=b'b'))
         assert p.can_read()
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'dave'
+        assert f.command == b'SEND'
+        assert f.body == b'dave'
         assert f.headers == {
-            'a': 'b',
-            'content-length': '4',
-            'destination': '/foo/bar',
+            b'a': b'b',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar',
         }
 
     def test_one_ignore_eol(self):
         p = tinystomp.Parser()
-        eols = '\n\r\n\n'
-        p.receive(eols + tinystomp.send('/foo/bar', 'dave', a='b') + eols)
+        eols = b'\n\r\n\n'
+        p.receive(eols + tinystomp.send(b'/foo/bar', b'dave', a=b'b') + eols)
         assert p.can_read()
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'dave'
+        assert f.command == b'SEND'
+        assert f.body == b'dave'
         assert f.headers == {
-            'a': 'b',
-            'content-length': '4',
-            'destination': '/foo/bar',
+            b'a': b'b',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar',
         }
         assert not p.can_read()
 
     def test_two_nobody(self):
         p = tinystomp.Parser()
-        p.receive(tinystomp.connect('host') * 2)
+        p.receive(tinystomp.connect(b'host') * 2)
         for x in range(2):
             assert p.can_read()
             f = p.next()
-            assert f.command == 'CONNECT'
-            assert f.body == ''
+            assert f.command == b'CONNECT'
+            assert f.body == b''
             assert f.headers == {
-                'accept-version': '1.0,1.1,1.2',
-                'host': 'host'
+                b'accept-version': b'1.0,1.1,1.2',
+                b'host': b'host'
             }
         assert not p.can_read()
 
     def test_two_body(self):
         p = tinystomp.Parser()
-        p.receive(tinystomp.send('/foo/bar', 'dave', a='b') * 2)
+        p.receive(tinystomp.send(b'/foo/bar', b'dave', a=b'b') * 2)
         for x in range(2):
             assert p.can_read()
             f = p.next()
-            assert f.command == 'SEND'
-            assert f.body == 'dave'
+            assert f.command == b'SEND'
+            assert f.body == b'dave'
             assert f.headers == {
-                'a': 'b',
-                'content-length': '4',
-                'destination': '/foo/bar',
+                b'a': b'b',
+                b'content-length': b'4',
+                b'destination': b'/foo/bar',
             }
 
     def test_two_ignore_eol(self):
         p = tinystomp.Parser()
-        eols = '\n\r\n\n'
-        p.receive((eols+tinystomp.send('/foo/bar', 'dave', a='b')+eols) * 2)
+        eols = b'\n\r\n\n'
+        p.receive((eols+tinystomp.send(b'/foo/bar', b'dave', a=b'b')+eols) * 2)
         for x in range(2):
             assert p.can_read()
             f = p.next()
-            assert f.command == 'SEND'
-            assert f.body == 'dave'
+            assert f.command == b'SEND'
+            assert f.body == b'dave'
             assert f.headers == {
-                'a': 'b',
-                'content-length': '4',
-                'destination': '/foo/bar',
+                b'a': b'b',
+                b'content-length': b'4',
+                b'destination': b'/foo/bar',
             }
         assert not p.can_read()
 
     def test_one_partial_inverb(self):
         p = tinystomp.Parser()
-        eols = '\n\r\n\n'
-        s = eols + tinystomp.send('/foo/bar', 'dave', a='b') + eols
+        eols = b'\n\r\n\n'
+        s = eols + tinystomp.send(b'/foo/bar', b'dave', a=b'b') + eols
         p.receive(s[:6])
         assert not p.can_read()
         p.receive(s[6:])
         assert p.can_read()
 
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'dave'
+        assert f.command == b'SEND'
+        assert f.body == b'dave'
         assert f.headers == {
-            'a': 'b',
-            'content-length': '4',
-            'destination': '/foo/bar',
+            b'a': b'b',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar',
         }
 
     def test_one_partial_ineols(self):
         p = tinystomp.Parser()
-        eols = '\n\r\n\n'
-        s = eols + tinystomp.send('/foo/bar', 'dave', a='b') + eols
+        eols = b'\n\r\n\n'
+        s = eols + tinystomp.send(b'/foo/bar', b'dave', a=b'b') + eols
         p.receive(s[:3])
         assert not p.can_read()
         p.receive(s[3:])
         assert p.can_read()
 
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'dave'
+        assert f.command == b'SEND'
+        assert f.body == b'dave'
         assert f.headers == {
-            'a': 'b',
-            'content-length': '4',
-            'destination': '/foo/bar',
+            b'a': b'b',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar',
         }
 
     def test_one_partial_inheader(self):
         p = tinystomp.Parser()
-        eols = '\n\r\n\n'
-        s = eols + tinystomp.send('/foo/bar', 'dave', a='b') + eols
+        eols = b'\n\r\n\n'
+        s = eols + tinystomp.send(b'/foo/bar', b'dave', a=b'b') + eols
         p.receive(s[:12])
         assert not p.can_read()
         p.receive(s[12:])
         assert p.can_read()
 
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'dave'
+        assert f.command == b'SEND'
+        assert f.body == b'dave'
         assert f.headers == {
-            'a': 'b',
-            'content-length': '4',
-            'destination': '/foo/bar',
+            b'a': b'b',
+            b'content-length': b'4',
+            b'destination': b'/foo/bar',
         }
 
     def test_one_partial_inbody(self):
         p = tinystomp.Parser()
-        eols = '\n\r\n\n'
-        s = eols + tinystomp.send('/foo/bar', 'dave'*2000, a='b') + eols
+        eols = b'\n\r\n\n'
+        s = eols + tinystomp.send(b'/foo/bar', b'dave'*2000, a=b'b') + eols
 
         p.receive(s[:150])
         assert not p.can_read()
@@ -383,23 +847,185 @@ class ParserReceiveTest(unittest.TestCase):
         assert p.can_read()
 
         f = p.next()
-        assert f.command == 'SEND'
-        assert f.body == 'dave'*2000
+        assert f.command == b'SEND'
+        assert f.body == b'dave'*2000
         assert f.headers == {
-            'a': 'b',
-            'content-length': '8000',
-            'destination': '/foo/bar',
+            b'a': b'b',
+            b'content-length': b'8000',
+            b'destination': b'/foo/bar',
         }
 
 
+    def test_one_buffer(self):
+        s = tinystomp.send(b'/foo/bar', b'dave')
+        for buf in bytearray(s), memoryview(s):
+            p = tinystomp.Parser()
+            p.receive(buf)
+            f = p.next()
+            assert type(f.command) is bytes
+            assert type(f.body) is bytes
+            assert f.body == b'dave'
+
+    def test_one_reused_buffer(self):
+        s = tinystomp.send(b'/foo/bar', b'dave')
+        buf = bytearray(s)
+        view = memoryview(buf)
+        p = tinystomp.Parser()
+        p.receive(view[:10])
+        buf[:10] = b'\x00' * 10
+        p.receive(view[10:])
+        assert p.next().body == b'dave'
+
+    def test_one_body_nul(self):
+        p = tinystomp.Parser()
+        s = tinystomp.send(b'/foo/bar', b'da\x00ve')
+        p.receive(s[:-3])
+        assert not p.can_read()
+        p.receive(s[-3:])
+        f = p.next()
+        assert f.body == b'da\x00ve'
+
+    def test_one_body_overrun(self):
+        p = tinystomp.Parser()
+        s = b'SEND\ncontent-length:2\n\ndave\x00'
+        self.assertRaises(tinystomp.ProtocolError, p.receive, s)
+
+    def test_one_encoded(self):
+        p = tinystomp.Parser(decoders=tinystomp.DECODERS)
+        p.receive(tinystomp.send(b'/foo/bar', b'dave'*2000, compress_=0))
+        f = p.next()
+        assert isinstance(f, tinystomp.EncodedFrame)
+        assert f.raw_body == zlib.compress(b'dave'*2000)
+        assert f.body == b'dave'*2000
+
+    def test_one_encoded_no_decoders(self):
+        p = tinystomp.Parser()
+        p.receive(tinystomp.send(b'/foo/bar', b'dave'*2000, compress_=0))
+        f = p.next()
+        assert type(f) is tinystomp.Frame
+        assert f.body == zlib.compress(b'dave'*2000)
+
+    def test_one_unknown_encoding(self):
+        p = tinystomp.Parser(decoders=tinystomp.DECODERS)
+        p.receive(tinystomp.send(b'/foo/bar', b'dave', content_encoding=b'xx'))
+        f = p.next()
+        assert type(f) is tinystomp.Frame
+        assert f.body == b'dave'
+
+
+class ParserComplexityTest(unittest.TestCase):
+    # Each case is parsed at size N and 4N. Linear parsing takes ~4x longer,
+    # quadratic parsing ~16x.
+    N = 10000
+    MAX_RATIO = 8
+
+    def parse(self, chunks):
+        p = tinystomp.Parser()
+        t0 = time.time()
+        for chunk in chunks:
+            p.receive(chunk)
+        return time.time() - t0, p
+
+    def assertLinear(self, gen):
+        small = gen(self.N)
+        large = gen(self.N * 4)
+        t_small = min(self.parse(small)[0] for _ in range(3))
+        t_large = min(self.parse(large)[0] for _ in range(3))
+        ratio = t_large / max(t_small, 1e-4)
+        assert ratio < self.MAX_RATIO, ratio
+        return self.parse(large)[1]
+
+    def chunked(self, s, size):
+        return [s[i:i+size] for i in range(0, len(s), size)]
+
+    def test_heartbeats(self):
+        p = self.assertLinear(lambda n: [b'\n' * n])
+        assert p.s == b''
+        assert not p.can_read()
+
+    def test_heartbeats_bytewise(self):
+        p = self.assertLinear(lambda n: [b'\r', b'\n'] * n)
+        assert p.s == b''
+
+    def test_heartbeats_after_frame(self):
+        frame = tinystomp.ack(b'1')
+        p = self.assertLinear(lambda n: [frame] + [b'\n'] * n)
+        assert p.next().command == b'ACK'
+        assert p.s == b''
+
+    def test_heartbeats_before_frame(self):
+        frame = tinystomp.ack(b'1')
+        p = self.assertLinear(lambda n: [b'\n' * n + frame])
+        assert p.next().command == b'ACK'
+
+    def test_many_frames(self):
+        frame = tinystomp.ack(b'1')
+        p = self.assertLinear(lambda n: [frame * (n // 10)])
+        assert len(p.frames) == self.N * 4 // 10
+        assert p.s == b''
+
+    def test_huge_headers(self):
+        def gen(n):
+            headers = dict(('h%d' % i, b'v') for i in range(n // 10))
+            return [tinystomp.send(b'/foo/bar', b'x', **headers)]
+        p = self.assertLinear(gen)
+        assert len(p.next().headers) == (self.N * 4 // 10) + 2
+
+    def test_huge_headers_chunked(self):
+        def gen(n):
+            headers = dict(('h%d' % i, b'v') for i in range(n // 10))
+            return self.chunked(tinystomp.send(b'/foo/bar', b'x', **headers), 16)
+        p = self.assertLinear(gen)
+        assert len(p.next().headers) == (self.N * 4 // 10) + 2
+
+    def test_nul_body(self):
+        p = self.assertLinear(lambda n: [tinystomp.send(b'/foo/bar', b'\x00' * n)])
+        assert p.next().body == b'\x00' * self.N * 4
+
+    def test_nul_body_chunked(self):
+        p = self.assertLinear(lambda n: self.chunked(
+            tinystomp.send(b'/foo/bar', b'\x00' * n * 10), 64))
+        assert p.next().body == b'\x00' * self.N * 40
+        assert p.s == b''
+
+    def test_body_bytewise(self):
+        p = self.assertLinear(lambda n: self.chunked(
+            tinystomp.send(b'/foo/bar', b'x' * n), 1))
+        assert p.next().body == b'x' * self.N * 4
+        assert p.s == b''
+
+    def test_frames_bytewise(self):
+        frame = tinystomp.send(b'/foo/bar', b'dave')
+        p = self.assertLinear(lambda n: self.chunked(frame * (n // 50), 1))
+        assert len(p.frames) == self.N * 4 // 50
+
+
 class ClientTest(unittest.TestCase):
+    def recv_into(self, *chunks):
+        chunks = list(chunks)
+        def recv_into(buf):
+            chunk = chunks.pop(0)
+            buf[:len(chunk)] = chunk
+            return len(chunk)
+        return mock.Mock(side_effect=recv_into)
+
     def test_constructor(self):
-        c = tinystomp.Client('host', 1234, 'login', 'passcode')
+        c = tinystomp.Client('host', 1234, 'login', 'passcode', 10)
         assert c.host == 'host'
         assert c.port == 1234
         assert c.login == 'login'
         assert c.passcode == 'passcode'
+        assert c.compress == 10
+        assert not c.trace
+        assert not c.parser.timestamps
+        assert c.bufsize == 0
+        assert c.buf == []
         assert isinstance(c.parser, tinystomp.Parser)
+        assert c.parser.decoders is tinystomp.DECODERS
+
+    def test_constructor_no_compress(self):
+        c = tinystomp.Client('host', 1234)
+        assert c.parser.decoders is None
 
     def test_from_url(self):
         c = tinystomp.Client.from_url('tcp://host:1234/')
@@ -414,33 +1040,404 @@ class ClientTest(unittest.TestCase):
         assert sock.mock_calls == [
             mock.call(),
             mock.call().connect(('host', 1234)),
-            mock.call().send(tinystomp.connect('host')),
+            mock.call().sendall(tinystomp.connect(b'host')),
         ]
 
     @mock.patch('socket.socket')
     def test_next(self, sock):
         sock.return_value = mock.Mock(
-            recv=mock.Mock(side_effect=[tinystomp.connect('host'), '']))
+            recv_into=self.recv_into(tinystomp.connect(b'host'), b''))
 
         c = tinystomp.Client.from_url('tcp://host:1234/')
         c.connect()
         f = c.next()
-        assert f.command == 'CONNECT'
+        assert f.command == b'CONNECT'
 
         self.assertRaises(tinystomp.ProtocolError, c.next)
 
-    def test_getattr_absent(self):
+    @mock.patch('socket.socket')
+    def test_next_flushes(self, sock):
+        sock.return_value = mock.Mock(
+            recv_into=self.recv_into(tinystomp.connect(b'host')))
+
+        c = tinystomp.Client.from_url('tcp://host:1234/')
+        c.connect()
+        c.subscribe(b'/foo/bar', id=b'1')
+        c.next()
+        assert sock.return_value.mock_calls[-2:] == [
+            mock.call.sendall(tinystomp.subscribe(b'/foo/bar', id=b'1')),
+            mock.call.recv_into(c.rbuf),
+        ]
+
+    def test_method_absent(self):
         c = tinystomp.Client.from_url('tcp://host:1234/')
         self.assertRaises(AttributeError, lambda: c.pants)
 
+    def test_method_present(self):
+        for name, args in [
+            ('subscribe', (b'/foo/bar', )),
+            ('unsubscribe', (b'/foo/bar', b'1')),
+            ('ack', (b'1', )),
+            ('nack', (b'1', )),
+            ('begin', (b'1', )),
+            ('commit', (b'1', )),
+            ('abort', (b'1', )),
+        ]:
+            method = getattr(tinystomp.Client, name)
+            assert method.__doc__ == getattr(tinystomp, name).__doc__
+            c = tinystomp.Client.from_url('tcp://host:1234/')
+            c.write = mock.Mock()
+            getattr(c, name)(*args, id=b'2', a=b'b')
+            assert c.write.mock_calls == [
+                mock.call(getattr(tinystomp, name)(*args, id=b'2', a=b'b')),
+            ]
+
+    @mock.patch('socket.socket')
+    def test_write_buffered(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', bufsize=100)
+        c.connect()
+        c.send(b'/foo/bar/', b'a', a=b'b')
+        c.ack(b'123')
+        assert len(sock.mock_calls) == 3
+        c.flush()
+        c.flush()
+        assert sock.mock_calls[3:] == [
+            mock.call().sendall(tinystomp.send(b'/foo/bar/', b'a', a=b'b') +
+                                tinystomp.ack(b'123')),
+        ]
+
     @mock.patch('socket.socket')
-    def test_getattr_present(self, sock):
+    def test_write_unbuffered(self, sock):
         c = tinystomp.Client.from_url('tcp://host:1234/')
         c.connect()
-        c.send('/foo/bar/', 'a', a='b')
-        assert sock.mock_calls == [
-            mock.call(),
-            mock.call().connect(('host', 1234)),
-            mock.call().send(tinystomp.connect('host')),
-            mock.call().send(tinystomp.send('/foo/bar/', 'a', a='b')),
+        c.send(b'/foo/bar/', b'a')
+        c.ack(b'1')
+        assert sock.mock_calls[3:] == [
+            mock.call().sendall(tinystomp.send(b'/foo/bar/', b'a')),
+            mock.call().sendall(tinystomp.ack(b'1')),
+        ]
+        assert c.buf == []
+
+    @mock.patch('socket.socket')
+    def test_write_bufsize(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', bufsize=20)
+        c.connect()
+        c.ack(b'1')
+        assert len(sock.mock_calls) == 3
+        c.ack(b'2')
+        assert sock.mock_calls[3:] == [
+            mock.call().sendall(tinystomp.ack(b'1') + tinystomp.ack(b'2')),
+        ]
+        assert c.buf == []
+        assert c.buffered == 0
+
+    @mock.patch('socket.socket')
+    def test_disconnect_flushes(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', bufsize=100)
+        c.connect()
+        c.ack(b'1')
+        c.disconnect(b'2')
+        assert sock.mock_calls[3:] == [
+            mock.call().sendall(tinystomp.ack(b'1') +
+                                tinystomp.disconnect(b'2')),
+        ]
+
+    @mock.patch('socket.socket')
+    def test_close_flushes(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', bufsize=100)
+        c.connect()
+        c.ack(b'1')
+        c.close()
+        assert sock.mock_calls[3:] == [
+            mock.call().sendall(tinystomp.ack(b'1')),
+            mock.call().close(),
+        ]
+        assert c.s is None
+        c.close()
+
+    @mock.patch('socket.socket')
+    def test_context_manager(self, sock):
+        with tinystomp.Client.from_url('tcp://host:1234/', bufsize=100) as c:
+            c.connect()
+            c.ack(b'1')
+            assert len(sock.mock_calls) == 3
+        assert sock.mock_calls[3:] == [
+            mock.call().sendall(tinystomp.ack(b'1')),
+            mock.call().close(),
+        ]
+
+    @mock.patch('socket.socket')
+    def test_context_manager_error(self, sock):
+        sock.return_value.sendall.side_effect = socket.error('EPIPE')
+        def run():
+            with tinystomp.Client.from_url('tcp://host:1234/',
+                                           bufsize=100) as c:
+                c.s = sock.return_value
+                c.ack(b'1')
+                raise ValueError('boom')
+        self.assertRaises(ValueError, run)
+        assert sock.mock_calls == [mock.call().close()]
+
+    @mock.patch('socket.socket')
+    def test_send_trace(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', trace=True)
+        assert c.parser.timestamps
+        c.connect()
+        c.send(b'/foo/bar/', b'a')
+        c.flush()
+        assert b'trace-id:' in sock.mock_calls[-1][1][0]
+
+    @mock.patch('socket.socket')
+    def test_send_compress(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', compress=10)
+        c.connect()
+        c.send(b'/foo/bar/', b'a'*100)
+        c.flush()
+        assert sock.mock_calls[-1] == mock.call().sendall(
+            tinystomp.send(b'/foo/bar/', b'a'*100, compress_=10))
+        assert b'content-encoding:deflate' in sock.mock_calls[-1][1][0]
+
+    @mock.patch('socket.socket')
+    def test_send_option_names_are_headers(self, sock):
+        c = tinystomp.Client.from_url('tcp://host:1234/', compress=10)
+        c.connect()
+        c.send(b'/foo/bar/', b'a'*100, compress=b'no', compress_=None)
+        c.flush()
+        assert sock.mock_calls[-1] == mock.call().sendall(
+            tinystomp.send(b'/foo/bar/', b'a'*100, compress=b'no'))
+
+    def test_write_spool_disconnected(self):
+        spool = mock.Mock(__len__=mock.Mock(return_value=0))
+        c = tinystomp.Client.from_url('tcp://host:1234/', spool=spool)
+        c.send(b'/foo/bar', b'a')
+        c.flush()
+        assert spool.append.mock_calls == [
+            mock.call(tinystomp.send(b'/foo/bar', b'a')),
+        ]
+
+    @mock.patch('socket.socket')
+    def test_write_spool_session_frames(self, sock):
+        sock.return_value.send.side_effect = len
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'spool')
+
+        c = tinystomp.Client.from_url('tcp://host:1234/',
+                                      spool=tinystomp.Spool(path, 4096))
+        c.send(b'/foo/bar', b'a')
+        c.ack(b'msg-7')
+        c.send(b'/foo/bar', b'b', transaction=b'tx')
+        b = tinystomp.Batcher(c.write, prefix='p')
+        b.send(b'/foo/bar', b'c')
+        b.flush()
+        c.disconnect(b'r1')
+        c.spool.close()
+
+        c = tinystomp.Client.from_url('tcp://host:1234/',
+                                      spool=tinystomp.Spool(path, 4096))
+        c.connect()
+        sent = b''.join(tobytes(call[1][0]) for call in sock.mock_calls[2:])
+        assert sent == (
+            tinystomp.connect(b'host') +
+            tinystomp.send(b'/foo/bar', b'a') +
+            tinystomp.begin('p-0') +
+            tinystomp.send(b'/foo/bar', b'c', transaction='p-0') +
+            tinystomp.commit('p-0')
+        )
+
+    @mock.patch('socket.socket')
+    def test_write_spool_error(self, sock):
+        sock.return_value.send.side_effect = socket.error()
+        spool = mock.Mock(__len__=mock.Mock(return_value=0))
+        c = tinystomp.Client.from_url('tcp://host:1234/', spool=spool)
+        c.connect()
+        c.send(b'/foo/bar', b'a')
+        c.ack(b'123')
+        c.flush()
+        assert c.s is None
+        assert spool.append.mock_calls == [
+            mock.call(tinystomp.send(b'/foo/bar', b'a')),
+        ]
+        assert sock.return_value.close.mock_calls == [mock.call()]
+        self.assertRaises(tinystomp.ProtocolError, c.next)
+
+    @mock.patch('socket.socket')
+    def test_write_spool_partial(self, sock):
+        first = tinystomp.send(b'/foo/bar', b'a')
+        sock.return_value.send.side_effect = [len(first) + 3, socket.error()]
+        spool = mock.Mock(__len__=mock.Mock(return_value=0))
+        c = tinystomp.Client.from_url('tcp://host:1234/', spool=spool,
+                                      bufsize=100)
+        c.connect()
+        c.send(b'/foo/bar', b'a')
+        c.send(b'/foo/bar', b'b')
+        c.send(b'/foo/bar', b'c')
+        c.flush()
+        assert c.s is None
+        assert spool.append.mock_calls == [
+            mock.call(tinystomp.send(b'/foo/bar', b'b') +
+                      tinystomp.send(b'/foo/bar', b'c')),
+        ]
+
+    @mock.patch('socket.socket')
+    def test_write_spool_short_writes(self, sock):
+        pkt = tinystomp.send(b'/foo/bar', b'a')
+        sock.return_value.send.side_effect = [
+            5, socket.error(errno.EINTR, 'EINTR'), len(pkt) - 5]
+        spool = mock.Mock(__len__=mock.Mock(return_value=0))
+        c = tinystomp.Client.from_url('tcp://host:1234/', spool=spool)
+        c.connect()
+        c.send(b'/foo/bar', b'a')
+        calls = sock.return_value.send.mock_calls
+        assert [tobytes(call[1][0]) for call in calls] == \
+            [pkt, pkt[5:], pkt[5:]]
+        assert spool.append.mock_calls == []
+        assert c.s is sock.return_value
+
+    def test_next_disconnected(self):
+        c = tinystomp.Client.from_url('tcp://host:1234/')
+        self.assertRaises(tinystomp.ProtocolError, c.next)
+
+    def test_flush_disconnected(self):
+        c = tinystomp.Client.from_url('tcp://host:1234/', bufsize=100)
+        c.send(b'/foo/bar', b'a')
+        self.assertRaises(tinystomp.ProtocolError, c.flush)
+
+    @mock.patch('socket.socket')
+    def test_connect_drains_spool(self, sock):
+        sock.return_value.send.side_effect = len
+        spool = mock.Mock(__len__=mock.Mock(return_value=1))
+        c = tinystomp.Client.from_url('tcp://host:1234/', spool=spool)
+        c.connect()
+        assert spool.drain.mock_calls == [mock.call(sock.return_value.send)]
+
+
+class ConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.parser.can_read.return_value = False
+        self.handler = mock.Mock()
+        self.consumer = tinystomp.Consumer(self.client, b'/queue/foo',
+            self.handler, target=0.1, max_prefetch=100, a=b'b')
+        self.consumer.prefix = 'p'
+
+    def message(self, id_, subscription=b'p-0'):
+        f = tinystomp.Frame(b'MESSAGE')
+        f.headers.update({b'message-id': id_, b'subscription': subscription})
+        return f
+
+    def test_constructor(self):
+        c = self.consumer
+        assert c.client is self.client
+        assert c.destination == b'/queue/foo'
+        assert c.handler is self.handler
+        assert c.target == 0.1
+        assert c.adaptive
+        assert c.prefetch == 1
+        assert c.headers == {'a': b'b'}
+        assert c.id is None
+        assert c.latency is None
+
+    def test_subscribe(self):
+        self.consumer.subscribe()
+        self.consumer.subscribe()
+        assert self.client.mock_calls == [
+            mock.call.subscribe(b'/queue/foo', **{
+                'a': b'b',
+                'ack': 'client-individual',
+                'activemq.prefetchSize': '1',
+                'id': b'p-0',
+            }),
+            mock.call.unsubscribe(b'/queue/foo', b'p-0'),
+            mock.call.subscribe(b'/queue/foo', **{
+                'a': b'b',
+                'ack': 'client-individual',
+                'activemq.prefetchSize': '1',
+                'id': b'p-1',
+            }),
+        ]
+
+    def test_handle_error(self):
+        self.consumer.subscribe()
+        self.assertRaises(tinystomp.ProtocolError,
+            self.consumer.handle, tinystomp.Frame(b'ERROR'))
+
+    def test_handle_other(self):
+        self.consumer.subscribe()
+        assert not self.consumer.handle(tinystomp.Frame(b'RECEIPT'))
+        assert not self.consumer.handle(self.message(b'1', b'p-old'))
+        assert self.handler.mock_calls == []
+
+    @mock.patch('time.time')
+    def test_handle_grows(self, time):
+        time.side_effect = [0.0, 0.005]
+        self.consumer.subscribe()
+        f = self.message(b'1')
+        assert self.consumer.handle(f)
+        assert self.handler.mock_calls == [mock.call(f)]
+        assert self.consumer.latency == 0.005
+        assert self.consumer.prefetch == 20
+        assert self.client.ack.mock_calls == [
+            mock.call(b'1', message_id=b'1', subscription=b'p-0'),
+        ]
+        assert self.client.unsubscribe.mock_calls == [
+            mock.call(b'/queue/foo', b'p-0'),
+        ]
+        assert self.client.subscribe.mock_calls[-1] == mock.call(b'/queue/foo', **{
+            'a': b'b',
+            'ack': 'client-individual',
+            'activemq.prefetchSize': '20',
+            'id': b'p-1',
+        })
+
+    @mock.patch('time.time')
+    def test_handle_clamped(self, time):
+        time.side_effect = [0.0, 0.0]
+        self.consumer.subscribe()
+        self.consumer.handle(self.message(b'1'))
+        assert self.consumer.prefetch == 100
+
+    @mock.patch('time.time')
+    def test_handle_hysteresis(self, time):
+        self.consumer.subscribe()
+        self.consumer.prefetch = 10
+        self.consumer.latency = 0.01
+        time.side_effect = [0.0, 0.015]
+        self.consumer.handle(self.message(b'1'))
+        assert self.consumer.prefetch == 10
+        assert self.consumer.id == b'p-0'
+
+    @mock.patch('time.time')
+    def test_handle_deferred_while_queued(self, time):
+        self.client.parser.can_read.return_value = True
+        time.side_effect = [0.0, 0.01]
+        self.consumer.subscribe()
+        self.consumer.handle(self.message(b'1'))
+        assert self.consumer.prefetch == 1
+        assert self.consumer.id == b'p-0'
+
+    @mock.patch('time.time')
+    def test_handle_topic_fixed(self, time):
+        consumer = tinystomp.Consumer(self.client, b'/topic/foo',
+            self.handler, target=0.1, max_prefetch=100)
+        time.side_effect = [0.0, 0.005]
+        consumer.prefix = 'p'
+        assert not consumer.adaptive
+        assert consumer.prefetch == 100
+        consumer.subscribe()
+        f = self.message('1')
+        f.headers[b'destination'] = b'/topic/foo'
+        assert consumer.handle(f)
+        assert consumer.prefetch == 100
+        assert consumer.id == b'p-0'
+        assert self.client.unsubscribe.mock_calls == []
+
+    def test_run_count(self):
+        self.client.next.side_effect = [
+            tinystomp.Frame(b'RECEIPT'),
+            self.message(b'1'),
+            self.message(b'2'),
         ]
+        self.consumer.max_prefetch = 1
+        self.consumer.run(2)
+        assert len(self.handler.mock_calls) == 2